@@ -1,14 +1,13 @@
-import json
-import os
-import re
+import html
 import shlex
 import subprocess
 import sys
 from collections import deque
+from itertools import islice
 
-from PyQt6.QtCore import QObject, QPoint, QSettings, QSize, Qt, QTimer, pyqtSlot
-from PyQt6.QtDBus import QDBusConnection, QDBusInterface
-from PyQt6.QtGui import QClipboard, QFont, QKeySequence, QShortcut
+from PyQt6.QtCore import QMetaType, QObject, QPoint, QProcess, QSettings, QSize, Qt, QTimer, pyqtClassInfo, pyqtSlot
+from PyQt6.QtDBus import QDBusAbstractAdaptor, QDBusArgument, QDBusConnection, QDBusInterface, QDBusMessage
+from PyQt6.QtGui import QAbstractTextDocumentLayout, QClipboard, QFont, QKeySequence, QPalette, QShortcut, QTextDocument
 from PyQt6.QtWidgets import (
     QApplication,
     QHBoxLayout,
@@ -20,10 +19,68 @@ from PyQt6.QtWidgets import (
     QPushButton,
     QSizePolicy,
     QSpinBox,
+    QStyle,
+    QStyledItemDelegate,
+    QStyleOptionViewItem,
     QVBoxLayout,
     QWidget,
 )
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+@pyqtClassInfo("D-Bus Interface", "org.srst.ClipboardMonitor")
+class ExplainAdaptor(QDBusAbstractAdaptor):
+    """Exposes only the explain method of the monitor on D-Bus"""
+
+    def __init__(self, monitor):
+        super().__init__(monitor)
+        self.monitor = monitor
+
+    @pyqtSlot(result=str)
+    def explain(self):
+        return self.monitor.explain()
+
+
+class HtmlItemDelegate(QStyledItemDelegate):
+    """Renders the display text of list items as HTML"""
+
+    def make_document(self, options):
+        document = QTextDocument()
+        document.setDocumentMargin(0)
+        document.setDefaultFont(options.font)
+        document.setHtml(options.text)
+        return document
+
+    def paint(self, painter, option, index):
+        options = QStyleOptionViewItem(option)
+        self.initStyleOption(options, index)
+        document = self.make_document(options)
+
+        # Let the style draw the background and selection, then the text on top
+        options.text = ""
+        style = options.widget.style() if options.widget else QApplication.style()
+        style.drawControl(QStyle.ControlElement.CE_ItemViewItem, options, painter, options.widget)
+
+        context = QAbstractTextDocumentLayout.PaintContext()
+        if options.state & QStyle.StateFlag.State_Selected:
+            context.palette.setColor(QPalette.ColorRole.Text, options.palette.color(QPalette.ColorRole.HighlightedText))
+        text_rect = style.subElementRect(QStyle.SubElement.SE_ItemViewItemText, options, options.widget)
+        painter.save()
+        painter.translate(text_rect.topLeft())
+        painter.setClipRect(text_rect.translated(-text_rect.topLeft()))
+        document.documentLayout().draw(painter, context)
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        options = QStyleOptionViewItem(option)
+        self.initStyleOption(options, index)
+        document = self.make_document(options)
+        return QSize(int(document.idealWidth()), int(document.size().height()))
+
 
 class ClipboardMonitor(QMainWindow):
     def __init__(self, app):
@@ -32,11 +89,37 @@ class ClipboardMonitor(QMainWindow):
         self.clipboard = QApplication.clipboard()
         self.last_text = ""
         self.history_size = 10
+        # Entries are (text, len(text), matches) where matches lists the other
+        # entries contained in the text, kept up to date as the history changes
         self.clipboard_history = deque(maxlen=self.history_size)
+        # Stripped texts of the history entries, to skip near-duplicates
+        self._history_keys = set()
+        self._automaton = None
+        self._automaton_dirty = True
+        self._explain_cache = None
+        self._explain_dirty = True
+        # (text, matches) of the rows currently shown, newest first
+        self._displayed = []
+        # The QListWidgetItem of each shown row, in the same order
+        self._row_items = []
         self.target_window_id = None
         self.dbus_service_name = "org.srst.ClipboardMonitor"
         self.dbus_object_path = "/ClipboardMonitor"
-        self.window_config_file = "/tmp/srst_clips_window_config.json"
+        self._notify_iface = None
+        self.settings = QSettings('srst', 'ClipboardMonitor')
+        self._last_saved_config = None
+
+        # Moving or resizing the window emits an event per step, write the config
+        # only once the window has settled
+        self._save_timer = QTimer(self)
+        self._save_timer.setSingleShot(True)
+        self._save_timer.setInterval(500)
+        self._save_timer.timeout.connect(self._do_save_window_geometry)
+
+        # Picking a window waits for a click, run it without blocking the event loop
+        self._select_window_proc = QProcess(self)
+        self._select_window_proc.finished.connect(self._on_select_window_done)
+        self._select_window_proc.errorOccurred.connect(self._on_select_window_error)
 
         # Allow the window to be as small as possible
         self.setMinimumWidth(1)
@@ -78,6 +161,7 @@ class ClipboardMonitor(QMainWindow):
 
         self.history_list = QListWidget()
         self.history_list.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.history_list.setItemDelegate(HtmlItemDelegate(self.history_list))
         layout.addWidget(self.history_list)
 
         button_layout = QHBoxLayout()
@@ -122,38 +206,35 @@ class ClipboardMonitor(QMainWindow):
 
     def restore_window_geometry(self):
         try:
-            if os.path.exists(self.window_config_file):
-                with open(self.window_config_file, 'r') as f:
-                    config = json.load(f)
+            geometry = self.settings.value('geom', b'')
+            if geometry:
+                self.restoreGeometry(geometry)
 
-                    if 'pos_x' in config and 'pos_y' in config:
-                        self.move(config['pos_x'], config['pos_y'])
+            target_window_id = self.settings.value('target_window_id')
+            if target_window_id:
+                self.target_window_id = target_window_id
+                self.status_label.setText(f"Selected window: {self.target_window_id}")
 
-                    if 'width' in config and 'height' in config:
-                        self.resize(config['width'], config['height'])
-
-                    if 'target_window_id' in config and config['target_window_id']:
-                        self.target_window_id = config['target_window_id']
-                        self.status_label.setText(f"Selected window: {self.target_window_id}")
-
-                print(f"Configuration restored from {self.window_config_file}")
+            print(f"Configuration restored from {self.settings.fileName()}")
         except Exception as e:
             print(f"Error restoring configuration: {e}")
 
     def save_window_geometry(self):
+        self._save_timer.start()
+
+    def _do_save_window_geometry(self):
         try:
-            config = {
-                'pos_x': self.pos().x(),
-                'pos_y': self.pos().y(),
-                'width': self.width(),
-                'height': self.height(),
-                'target_window_id': self.target_window_id
-            }
-
-            with open(self.window_config_file, 'w') as f:
-                json.dump(config, f)
-
-            print(f"Configuration saved to {self.window_config_file}")
+            geometry = self.saveGeometry()
+            config = (geometry.data(), self.target_window_id)
+            if config == self._last_saved_config:
+                return
+
+            # QSettings keeps the values in memory and flushes them to disk itself
+            self.settings.setValue('geom', geometry)
+            self.settings.setValue('target_window_id', self.target_window_id)
+            self._last_saved_config = config
+
+            print(f"Configuration saved to {self.settings.fileName()}")
         except Exception as e:
             print(f"Error saving configuration: {e}")
 
@@ -166,27 +247,38 @@ class ClipboardMonitor(QMainWindow):
         self.save_window_geometry()
 
     def closeEvent(self, event):
-        self.save_window_geometry()
+        self._save_timer.stop()
+        self._do_save_window_geometry()
+        self.settings.sync()
         super().closeEvent(event)
 
     def setup_clipboard_monitoring(self):
+        # Bursts of clipboard changes are coalesced into a single update
+        self._debounce = QTimer(self)
+        self._debounce.setSingleShot(True)
+        self._debounce.setInterval(100)
+        self._debounce.timeout.connect(self._commit_clipboard)
         self.clipboard.dataChanged.connect(self.on_clipboard_change)
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.check_clipboard)
-        self.timer.start(500)
 
     def setup_dbus(self):
-        if not QDBusConnection.sessionBus().isConnected():
+        bus = QDBusConnection.sessionBus()
+        if not bus.isConnected():
             print("Could not connect to D-Bus session bus")
             return
 
-        if not QDBusConnection.sessionBus().registerService(self.dbus_service_name):
-            print(f"Could not register D-Bus service: {QDBusConnection.sessionBus().lastError().message()}")
+        self._notify_iface = QDBusInterface('org.freedesktop.Notifications', '/org/freedesktop/Notifications',
+                                            'org.freedesktop.Notifications', bus)
+
+        # Export the object before taking the name, so a client that sees the
+        # service appear can call explain right away
+        self.dbus_adaptor = ExplainAdaptor(self)
+        if not bus.registerObject(self.dbus_object_path, self, QDBusConnection.RegisterOption.ExportAdaptors):
+            print(f"Could not register object: {bus.lastError().message()}")
             return
 
-        if not QDBusConnection.sessionBus().registerObject(self.dbus_object_path, self,
-                                                          QDBusConnection.RegisterOption.ExportAllSlots):
-            print(f"Could not register object: {QDBusConnection.sessionBus().lastError().message()}")
+        if not bus.registerService(self.dbus_service_name):
+            print(f"Could not register D-Bus service: {bus.lastError().message()}")
+            bus.unregisterObject(self.dbus_object_path)
             return
 
         print(f"DBus service registered: {self.dbus_service_name}, object: {self.dbus_object_path}")
@@ -203,39 +295,53 @@ class ClipboardMonitor(QMainWindow):
 
     def update_history_size(self, size):
         self.history_size = size
-        new_history = deque(maxlen=size)
-        items_to_copy = list(self.clipboard_history)[-size:] if len(self.clipboard_history) > size else self.clipboard_history
-        for item in items_to_copy:
-            new_history.append(item)
-        self.clipboard_history = new_history
+        n = len(self.clipboard_history)
+        start = max(0, n - size)
+        dropped = {item for item, _, _ in islice(self.clipboard_history, start)}
+        self.clipboard_history = deque(islice(self.clipboard_history, start, n), maxlen=size)
+        self.discard_matches(dropped)
+        self._history_keys = {item.strip() for item, _, _ in self.clipboard_history}
+        self._automaton_dirty = True
         self.update_history_display()
+        self._explain_dirty = True
 
     def find_window(self):
+        if self._select_window_proc.state() != QProcess.ProcessState.NotRunning:
+            return
         self.status_label.setText("Please click on a window...")
-        try:
-            result = subprocess.run(['xwininfo'], capture_output=True, text=True)
-            if result.returncode == 0:
-                output = result.stdout
-                match = re.search(r'Window id: (0x[0-9a-fA-F]+)', output)
-                if match:
-                    self.target_window_id = match.group(1)
-                    self.status_label.setText(f"Selected window: {self.target_window_id}")
-                    print(f"Window ID: {self.target_window_id}")
-                    self.save_window_geometry()
-                else:
-                    self.status_label.setText("Could not find window ID in xwininfo output")
-            else:
-                self.status_label.setText("xwininfo failed")
-        except Exception as e:
-            self.status_label.setText(f"Error finding window: {str(e)}")
+        # selectwindow prints just the decimal id of the clicked window
+        self._select_window_proc.start('xdotool', ['selectwindow'])
 
-    def check_clipboard(self):
-        text = self.clipboard.text()
-        if text != self.last_text and text.strip():
-            self.process_clipboard_text(text)
+    def _on_select_window_done(self, exit_code, exit_status):
+        if exit_status != QProcess.ExitStatus.NormalExit or exit_code != 0:
+            self.status_label.setText("xdotool selectwindow failed")
+            return
+
+        output = self._select_window_proc.readAllStandardOutput().data().decode().strip()
+        if output.isdigit():
+            self.target_window_id = hex(int(output))
+            self.status_label.setText(f"Selected window: {self.target_window_id}")
+            print(f"Window ID: {self.target_window_id}")
+            self.save_window_geometry()
+        else:
+            self.status_label.setText("Could not find window ID in xdotool output")
+
+    def _on_select_window_error(self, error):
+        if error == QProcess.ProcessError.FailedToStart:
+            self.status_label.setText(f"Error finding window: {self._select_window_proc.errorString()}")
 
     def on_clipboard_change(self):
-        text = self.clipboard.text()
+        self._debounce.start()
+
+    def _commit_clipboard(self):
+        # Checking the offered formats is cheap, the text itself is only
+        # transferred when there is some
+        mime_data = self.clipboard.mimeData()
+        if mime_data is None or not mime_data.hasText():
+            return
+        text = mime_data.text()
+        if text == self.last_text:
+            return
         if text.strip():
             self.process_clipboard_text(text)
 
@@ -244,77 +350,245 @@ class ClipboardMonitor(QMainWindow):
             return
 
         self.last_text = text
-        self.clipboard_history.append(text)
+        key = text.strip()
+        if key in self._history_keys:
+            return
+
+        changed = False
+        evicted = None
+        if len(self.clipboard_history) == self.clipboard_history.maxlen:
+            evicted, _, _ = self.clipboard_history.popleft()
+            self._history_keys.discard(evicted.strip())
+            changed = self.discard_matches({evicted})
+
+        text_len = len(text)
+        for past_text, past_len, past_matches in self.clipboard_history:
+            if past_len > text_len and text in past_text:
+                past_matches.append(text)
+                changed = True
+
+        matches = self.find_contained(text, text_len)
+        self.clipboard_history.append((text, text_len, matches))
+        self._history_keys.add(key)
+        # The automaton is only needed to highlight rows, rebuild it lazily then
+        self._automaton_dirty = True
+        self._explain_dirty = True
 
-        matches = self.find_matches(text)
         if matches and len(matches) > 0:
             match_count = len(matches)
             self.show_notification(f"{match_count} matches found", text[:100] + ("..." if len(text) > 100 else ""))
 
-        self.update_history_display()
+        # Nothing but the new row changes when the text is unrelated to the history
+        if matches or changed:
+            self.update_history_display()
+        else:
+            self._prepend_history_row(text, evicted is not None)
+
+    def discard_matches(self, texts):
+        # Forget entries that left the history, returns whether any entry lost a match
+        changed = False
+        for _, _, matches in self.clipboard_history:
+            if any(match in texts for match in matches):
+                matches[:] = [match for match in matches if match not in texts]
+                changed = True
+        return changed
+
+    def _prepend_history_row(self, text, evicted):
+        self.insert_history_row(0, self.format_history_item(text, ()))
+        self._displayed.insert(0, (text, ()))
+        if evicted:
+            self.take_last_history_row()
+            self._displayed.pop()
 
     def show_notification(self, title, message):
+        # Talk to the notification daemon over the session bus we already have,
+        # notify-send is only the fallback
+        if self._notify_iface is not None and self._notify_iface.isValid():
+            reply = self._notify_iface.call(
+                'Notify',
+                'srst-clips',
+                QDBusArgument(0, QMetaType.Type.UInt.value),  # replaces_id
+                '',  # app_icon
+                title,
+                message,
+                QDBusArgument([], QMetaType.Type.QStringList.value),  # actions
+                {},  # hints
+                -1,  # expire_timeout
+            )
+            if reply.type() != QDBusMessage.MessageType.ErrorMessage:
+                return
+            print(f"Error showing notification: {reply.errorMessage()}")
+
         try:
             subprocess.run(["notify-send", title, message], check=False)
         except Exception as e:
             print(f"Error showing notification: {e}")
 
     def update_history_display(self):
-        self.history_list.clear()
-
-        for item in reversed(list(self.clipboard_history)):
-            matches = self.find_matches(item)
-            self.add_history_item(item, matches)
-
-    def find_matches(self, text):
-        matches = []
-        history_list = list(self.clipboard_history)
-        if text in history_list:
-            idx = history_list.index(text)
-            for i, past_text in enumerate(history_list):
-                if i != idx and past_text in text:
-                    matches.append(past_text)
-        return matches
-
-    def add_history_item(self, text, matches):
-        item = QListWidgetItem()
+        rows = [(text, tuple(matches)) for text, _, matches in reversed(self.clipboard_history)]
 
+        # Update the list with a single repaint at the end
+        self.history_list.setUpdatesEnabled(False)
+        self.history_list.blockSignals(True)
+        try:
+            if not self.update_history_rows(rows):
+                self.refill_history_rows(rows)
+            self._displayed = rows
+        finally:
+            self.history_list.blockSignals(False)
+            self.history_list.setUpdatesEnabled(True)
+
+    def update_history_rows(self, rows):
+        # Patch the shown rows in place when entries were only added at the top
+        # and evicted from the bottom, which is what a new clipboard text does
+        if not self._displayed:
+            return False
+        texts = [text for text, _ in rows]
+        first_text = self._displayed[0][0]
+        if first_text not in texts:
+            return False
+        added = texts.index(first_text)
+        kept = len(rows) - added
+        if [text for text, _ in self._displayed[:kept]] != texts[added:]:
+            return False
+
+        while len(self._row_items) > kept:
+            self.take_last_history_row()
+        for row in range(added - 1, -1, -1):
+            self.insert_history_row(0, self.format_history_item(*rows[row]))
+        for row in range(added, len(rows)):
+            if rows[row] != self._displayed[row - added]:
+                self._row_items[row].setText(self.format_history_item(*rows[row]))
+        return True
+
+    def refill_history_rows(self, rows):
+        # Reuse the existing items by position and only set the texts that differ
+        while len(self._row_items) < len(rows):
+            self.insert_history_row(len(self._row_items), "")
+        while len(self._row_items) > len(rows):
+            self.take_last_history_row()
+        for item, (text, matches) in zip(self._row_items, rows):
+            item_text = self.format_history_item(text, matches)
+            if item.text() != item_text:
+                item.setText(item_text)
+
+    def insert_history_row(self, row, text):
+        item = QListWidgetItem(text)
+        self.history_list.insertItem(row, item)
+        self._row_items.insert(row, item)
+
+    def take_last_history_row(self):
+        self.history_list.takeItem(len(self._row_items) - 1)
+        self._row_items.pop()
+
+    def history_automaton(self):
+        # Rebuild only when the history changed since the last call
+        if self._automaton_dirty:
+            automaton = ahocorasick.Automaton()
+            for past_text, past_len, _ in self.clipboard_history:
+                automaton.add_word(past_text, (past_text, past_len))
+            automaton.make_automaton()
+            self._automaton = automaton
+            self._automaton_dirty = False
+        return self._automaton
+
+    def find_contained(self, text, text_len):
+        # Only strictly shorter entries can be proper substrings, which also
+        # leaves out the text itself and its duplicates. The history changes
+        # with every text, so building an automaton here would cost more than
+        # the substring tests it saves
+        return [past_text for past_text, past_len, _ in self.clipboard_history
+                if past_len < text_len and past_text in text]
+
+    def find_match_spans(self, text, matches):
+        wanted = set(matches)
+        if ahocorasick is None:
+            spans = []
+            for match in wanted:
+                start = text.find(match)
+                while start != -1:
+                    spans.append((start, start + len(match)))
+                    start = text.find(match, start + 1)
+            return sorted(spans)
+
+        automaton = self.history_automaton()
+        return sorted((end - match_len + 1, end + 1) for end, (match, match_len) in automaton.iter(text) if match in wanted)
+
+    def format_history_item(self, text, matches):
+        # HTML collapses whitespace, pre-wrap keeps the line breaks and spacing
+        # of the clipboard text
         if matches:
-            html_text = text
-            for match in matches:
-                html_text = html_text.replace(match, f"<b>{match}</b>")
-
-            item.setText(f"({len(matches)}) {html_text}")
-        else:
-            item.setText(text)
-
-        self.history_list.addItem(item)
+            html_text = self.highlight_matches(text, matches)
+            return f'<span style="white-space:pre-wrap">({len(matches)}) {html_text}</span>'
+        return f'<span style="white-space:pre-wrap">{html.escape(text)}</span>'
+
+    def highlight_matches(self, text, matches):
+        spans = self.find_match_spans(text, matches)
+
+        parts = []
+        cursor = 0
+        i = 0
+        while i < len(spans):
+            start, end = spans[i]
+            i += 1
+            # Merge overlapping and adjacent spans into one bold run
+            while i < len(spans) and spans[i][0] <= end:
+                end = max(end, spans[i][1])
+                i += 1
+            parts.append(html.escape(text[cursor:start]))
+            parts.append("<b>")
+            parts.append(html.escape(text[start:end]))
+            parts.append("</b>")
+            cursor = end
+        parts.append(html.escape(text[cursor:]))
+        return "".join(parts)
 
     def explain_button_clicked(self):
         result = self.explain()
         self.status_label.setText(result)
 
     def reset_button_clicked(self):
-        self.clipboard_history.clear()
-        self.update_history_display()
+        self.clear_history()
         self.status_label.setText("History cleared")
 
-    @pyqtSlot()
+    def clear_history(self):
+        # An empty history has no rows to diff, drop them directly
+        self.clipboard_history.clear()
+        self._history_keys.clear()
+        self._automaton_dirty = True
+        self._explain_dirty = True
+        self.history_list.clear()
+        self._row_items.clear()
+        self._displayed = []
+
     def explain(self):
         if not self.target_window_id:
             print("No target window selected")
             return "No target window selected"
 
-        for item in reversed(list(self.clipboard_history)):
-            matches = self.find_matches(item)
+        explain_item = self.find_explain_item()
+        if explain_item is None:
+            return "No suitable text found"
+
+        item, matches = explain_item
+        formatted_text = self.format_text_for_ai(item, matches)
+        self.send_to_ai_window(formatted_text)
+        self.clear_history()
+        return f"Sent to AI: {item[:30]}..."
+
+    def find_explain_item(self):
+        # The most recent item with matches only changes when the history does
+        if not self._explain_dirty:
+            return self._explain_cache
+
+        self._explain_cache = None
+        for item, _, matches in reversed(self.clipboard_history):
             if len(matches) > 0:
-                formatted_text = self.format_text_for_ai(item, matches)
-                self.send_to_ai_window(formatted_text)
-                self.clipboard_history.clear()
-                self.update_history_display()
-                return f"Sent to AI: {item[:30]}..."
+                self._explain_cache = (item, matches)
+                break
 
-        return "No suitable text found"
+        self._explain_dirty = False
+        return self._explain_cache
 
     def format_text_for_ai(self, text, matches):
         sorted_matches = sorted(matches, key=len, reverse=True)
@@ -331,21 +605,25 @@ class ClipboardMonitor(QMainWindow):
         print(f"Sending text: {text}")
         try:
             original_clipboard = self.clipboard.text()
+            # Our own clipboard change is handled after the history is cleared,
+            # so mark it as seen to keep it out of the history
+            self.last_text = text
             self.clipboard.setText(text)
 
-            cmd_parts = [
-                f"xdotool windowactivate {self.target_window_id}",
-                "xdotool key Escape",
-                "sleep 0.2",
-                "xdotool key g i", # must have Vimium C browser extension installed for this to work
-                "sleep 0.2",
-                "xdotool key ctrl+v",
-                "sleep 0.2",
-                "xdotool key Return"
+            # xdotool chains the commands and sleeps itself, so one process
+            # does the whole sequence
+            args = [
+                "xdotool",
+                "windowactivate", "--sync", self.target_window_id,
+                "key", "Escape",
+                "sleep", "0.2",
+                "key", "g", "i", # must have Vimium C browser extension installed for this to work
+                "sleep", "0.2",
+                "key", "ctrl+v",
+                "sleep", "0.2",
+                "key", "Return",
             ]
-
-            full_cmd = ' && '.join(cmd_parts)
-            subprocess.run(full_cmd, shell=True)
+            subprocess.run(args)
             print(f"Sent text to window {self.target_window_id}")
 
         except Exception as e:
@@ -2,12 +2,12 @@
 import sys
 import subprocess
 import time
-from PyQt6.QtCore import QCoreApplication
-from PyQt6.QtDBus import QDBusConnection, QDBusInterface
+from PyQt6.QtCore import QCoreApplication, QTimer
+from PyQt6.QtDBus import QDBusConnection, QDBusInterface, QDBusServiceWatcher
 
 def is_service_running(bus, service_name):
     """Check if a DBus service is currently running"""
-    return service_name in bus.interface().registeredServiceNames().value()
+    return bus.interface().isServiceRegistered(service_name).value()
 
 def main():
     app = QCoreApplication(sys.argv)
@@ -26,20 +26,20 @@ def main():
         print("Clipboard monitor service not running, launching application...")
         
         try:
+            # Watch before launching so the registration cannot be missed
+            watcher = QDBusServiceWatcher(service_name, bus, QDBusServiceWatcher.WatchModeFlag.WatchForRegistration)
+            watcher.serviceRegistered.connect(lambda _: app.quit())
+
             # Start the clipboard monitor application
             subprocess.Popen(["srst-clips"], start_new_session=True)
             
             # Wait for the service to become available (with timeout)
-            max_wait = 5  # Maximum wait time in seconds
-            start_time = time.time()
-            
-            while time.time() - start_time < max_wait:
-                if is_service_running(bus, service_name):
-                    print("Service started successfully")
-                    # Give it a moment to fully initialize
-                    time.sleep(0.5)
-                    break
-                time.sleep(0.1)
+            max_wait_ms = 5000  # Maximum wait time in milliseconds
+            QTimer.singleShot(max_wait_ms, app.quit)
+            app.exec()
+
+            if is_service_running(bus, service_name):
+                print("Service started successfully")
             else:
                 print("Timed out waiting for service to start")
                 return 1
@@ -59,7 +59,7 @@ def main():
         print(f"Failed to create D-Bus interface: {bus.lastError().message()}")
         return 1
     
-    time.sleep(1.0)
+    time.sleep(1.0)  # wait for the Win key to be released
     print("Calling explain method...")
     reply = interface.call("explain")
     result = reply.arguments()[0] if reply.arguments() else 'No response'